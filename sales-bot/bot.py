@@ -5,16 +5,24 @@ Telegram бот для Insighteer.
 """
 
 import os
+import asyncio
 import logging
 import random
+import signal
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from aiogram import Bot, Dispatcher
+import uvloop
+from aiohttp import web
+from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, User
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,6 +35,13 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 
+# Настройки webhook (если WEBHOOK_URL не задан, бот работает через long polling)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Пустая строка (например, из docker-compose) означает, что секрет не задан
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен в переменных окружения")
 if not ADMIN_CHAT_ID:
@@ -35,28 +50,88 @@ if not ADMIN_CHAT_ID:
 # Преобразуем ADMIN_CHAT_ID в int для сравнения
 ADMIN_CHAT_ID_INT = int(ADMIN_CHAT_ID)
 
-# Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# Инициализация бота и диспетчера.
+# Одна aiohttp-сессия на все запросы: AiohttpSession держит общий TCPConnector
+# с пулом на limit соединений и DNS-кэшем, keep-alive — по умолчанию aiohttp
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(limit=100),
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
 dp = Dispatcher()
 
+# Методы отправки медиа по типу вложения
+_MEDIA_SEND = {
+    "photo": bot.send_photo,
+    "video": bot.send_video,
+    "document": bot.send_document,
+}
+
+# Префикс callback_data кнопки "Ответить" (за ним следует user_id)
+_REPLY_PREFIX = "reply_"
+
+# Максимальное число записей в словарях соответствий (старые вытесняются первыми)
+MESSAGE_MAP_MAX_SIZE = 10_000
+
 # Словарь для хранения соответствия между сообщениями админу и ID пользователей
 # Ключ: message_id сообщения в админском чате, Значение: user_id пользователя
-user_message_map = {}
+user_message_map = OrderedDict()
 
 # Словарь для хранения соответствия между сообщениями "Ответить" и ID пользователей
 # Ключ: message_id сообщения "Ответить" в админском чате, Значение: user_id пользователя
-reply_message_map = {}
+reply_message_map = OrderedDict()
+
+# Очередь всех исходящих сообщений в админский чат: (метод bot.send_*, kwargs, user_id или None).
+# Один обработчик отправляет их строго в порядке поступления.
+# Если указан user_id, к сообщению добавляется кнопка "Ответить"
+_admin_outbox = asyncio.Queue()
+ADMIN_OUTBOX_DRAIN_TIMEOUT = 10  # секунды на досылку очереди при остановке
 
 
+def _enqueue_admin(send, user_id: int | None = None, **kwargs):
+    """Ставит сообщение для админского чата в очередь отправки"""
+    _admin_outbox.put_nowait((send, kwargs, user_id))
+
+
+def _put(d: OrderedDict, key: int, value: int, cap: int = MESSAGE_MAP_MAX_SIZE):
+    """Сохраняет запись в словарь, вытесняя самые старые записи сверх лимита"""
+    d[key] = value
+    d.move_to_end(key)
+    while len(d) > cap:
+        d.popitem(last=False)
+
+
+@lru_cache(maxsize=4096)
 def create_reply_button(user_id: int) -> InlineKeyboardMarkup:
-    """Создает клавиатуру с кнопкой 'Ответить'"""
+    """Создает клавиатуру с кнопкой 'Ответить' (кэшируется по user_id, используется только для чтения)"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ответить", callback_data=f"reply_{user_id}")]
+        [InlineKeyboardButton(text="Ответить", callback_data=f"{_REPLY_PREFIX}{user_id}")]
     ])
     return keyboard
 
+# Приветственное сообщение для команды /start
+WELCOME_TEXT = (
+    "Привет! 👋\n\n"
+    "Insighteer позволяет тестировать маркетинговые креативы и стратегии.\n\n"
+    "Можете задать любой вопрос, и мы вам обязательно ответим 👌"
+)
+
+# Шаблоны сообщений для админского чата (заполняются через format_map)
+_PROFILE_TMPL = 'ID: {uid}\nИмя: {name}\nПрофиль: <a href="{link}">{label}</a>'
+ADMIN_START_TMPL = (
+    "<b>Пользователь нажал /start</b>\n\n"
+    "<b>Данные пользователя:</b>\n"
+    + _PROFILE_TMPL
+)
+ADMIN_MSG_TMPL = (
+    "<b>Сообщение от пользователя:</b>\n\n"
+    "{body}\n\n"
+    "<b>Данные пользователя:</b>\n"
+    + _PROFILE_TMPL
+)
+
 # Список мотивирующих фраз
-MOTIVATIONAL_PHRASES = [
+MOTIVATIONAL_PHRASES = (
     "Сегодня отличный день для новых достижений! 💪",
     "Каждый день - это новая возможность стать лучше! 🌟",
     "Верь в себя, и у тебя всё получится! ✨",
@@ -77,60 +152,57 @@ MOTIVATIONAL_PHRASES = [
     "Сегодня ты проявишь себя во всей красе! 🌺",
     "Твоя уверенность - твоя суперсила! 🦸",
     "Каждый день - это шанс стать легендой! 🏆"
-]
+)
+_choice = random.choice
 
 
-@dp.message(Command("start"))
-async def cmd_start(message: Message):
-    """Обработчик команды /start"""
-    welcome_text = (
-        "Привет! 👋\n\n"
-        "Insighteer позволяет тестировать маркетинговые креативы и стратегии.\n\n"
-        "Можете задать любой вопрос, и мы вам обязательно ответим 👌"
-    )
-    await message.answer(welcome_text)
+def _profile_fields(user: User) -> dict:
+    """Возвращает поля блока профиля (uid, name, link, label) для шаблонов админского чата"""
+    user_id = user.id
+    username = user.username
+    
+    # Формируем ссылку на профиль
+    if username:
+        profile_link = f"https://t.me/{username}"
+        label = f"t.me/{username}"
+    else:
+        profile_link = f"tg://user?id={user_id}"
+        label = f"t.me/user?id={user_id}"
     
-    # Отправляем информацию о пользователе в админский чат
+    return {
+        "uid": user_id,
+        "name": user.full_name or "Не указано",
+        "link": profile_link,
+        "label": label
+    }
+
+
+def notify_admin_about_start(message: Message):
+    """Ставит в очередь информацию о пользователе, нажавшем /start, для админского чата"""
     try:
         user_id = message.from_user.id
-        user_name = message.from_user.full_name or "Не указано"
-        username = message.from_user.username
-        
-        # Формируем ссылку на профиль
-        if username:
-            profile_link = f"https://t.me/{username}"
-        else:
-            profile_link = f"tg://user?id={user_id}"
-        
-        # Отправляем сообщение админу
-        admin_message = (
-            f"<b>Пользователь нажал /start</b>\n\n"
-            f"<b>Данные пользователя:</b>\n"
-            f"ID: {user_id}\n"
-            f"Имя: {user_name}\n"
-            f"Профиль: <a href=\"{profile_link}\">t.me/{username if username else f'user?id={user_id}'}</a>"
-        )
-        
-        sent_message = await bot.send_message(
-            chat_id=ADMIN_CHAT_ID_INT,
-            text=admin_message,
-            parse_mode=ParseMode.HTML,
-            reply_markup=create_reply_button(user_id)
-        )
+        admin_message = ADMIN_START_TMPL.format_map(_profile_fields(message.from_user))
         
-        # Сохраняем соответствие для возможных ответов
-        user_message_map[sent_message.message_id] = user_id
+        # Соответствие для возможных ответов сохранит обработчик очереди
+        _enqueue_admin(bot.send_message, user_id, text=admin_message)
         
     except Exception as e:
-        logger.error(f"Ошибка при отправке информации о /start в админский чат: {e}", exc_info=True)
+        logger.error("Ошибка при отправке информации о /start в админский чат: %s", e, exc_info=True)
 
 
-@dp.callback_query(lambda c: c.data.startswith("reply_"))
+@dp.message(Command("start"))
+async def cmd_start(message: Message):
+    """Обработчик команды /start"""
+    notify_admin_about_start(message)
+    await message.answer(WELCOME_TEXT)
+
+
+@dp.callback_query(F.data.startswith(_REPLY_PREFIX))
 async def handle_reply_button(callback: CallbackQuery):
     """Обработчик нажатия на кнопку 'Ответить'"""
     try:
         # Извлекаем ID пользователя из callback_data
-        user_id = int(callback.data.split("_")[1])
+        user_id = int(callback.data[len(_REPLY_PREFIX):])
         
         # Отправляем сообщение "Ответить пользователю" в админский чат
         reply_message = await bot.send_message(
@@ -140,16 +212,17 @@ async def handle_reply_button(callback: CallbackQuery):
         )
         
         # Сохраняем соответствие между сообщением "Ответить" и ID пользователя
-        reply_message_map[reply_message.message_id] = user_id
+        _put(reply_message_map, reply_message.message_id, user_id)
         
         await callback.answer("Теперь ответьте на сообщение выше, чтобы отправить ответ пользователю")
         
     except Exception as e:
-        logger.error(f"Ошибка при обработке кнопки 'Ответить': {e}", exc_info=True)
+        logger.error("Ошибка при обработке кнопки 'Ответить': %s", e, exc_info=True)
         await callback.answer("Произошла ошибка. Попробуйте позже.", show_alert=True)
 
 
-@dp.message(lambda m: m.chat.id == ADMIN_CHAT_ID_INT and m.reply_to_message)
+# Срабатывает только на ответы на сообщения "Ответить", остальное отсекается фильтром
+@dp.message(F.chat.id == ADMIN_CHAT_ID_INT, F.reply_to_message.message_id.in_(reply_message_map))
 async def handle_admin_reply(message: Message):
     """Обработчик ответов админа на сообщения 'Ответить пользователю'"""
     try:
@@ -159,29 +232,33 @@ async def handle_admin_reply(message: Message):
         # Ищем ID пользователя по ID сообщения "Ответить"
         user_id = reply_message_map.get(replied_message_id)
         
-        if not user_id:
-            # Если не найдено в reply_message_map, возможно это старый формат
+        if user_id is None:
+            # Запись могла быть вытеснена через _put из другой задачи
+            # уже после проверки фильтром
             return
         
         # Отправляем ответ пользователю
+        photo = message.photo
+        video = message.video
+        document = message.document
         reply_text = message.text or message.caption or "[Медиа-файл]"
         
-        if message.photo:
+        if photo:
             await bot.send_photo(
                 chat_id=user_id,
-                photo=message.photo[-1].file_id,
+                photo=photo[-1].file_id,
                 caption=reply_text
             )
-        elif message.video:
+        elif video:
             await bot.send_video(
                 chat_id=user_id,
-                video=message.video.file_id,
+                video=video.file_id,
                 caption=reply_text
             )
-        elif message.document:
+        elif document:
             await bot.send_document(
                 chat_id=user_id,
-                document=message.document.file_id,
+                document=document.file_id,
                 caption=reply_text
             )
         else:
@@ -193,126 +270,192 @@ async def handle_admin_reply(message: Message):
         await message.answer("✅ Ответ отправлен пользователю")
         
     except Exception as e:
-        logger.error(f"Ошибка при отправке ответа пользователю: {e}", exc_info=True)
+        logger.error("Ошибка при отправке ответа пользователю: %s", e, exc_info=True)
         await message.answer("Произошла ошибка при отправке ответа пользователю.")
 
 
+@dp.message(F.chat.id == ADMIN_CHAT_ID_INT, F.reply_to_message)
+async def ignore_admin_reply(message: Message):
+    """Прочие ответы в админском чате не пересылаются, как и раньше"""
+
+
 @dp.message()
 async def handle_message(message: Message):
     """Обработчик всех сообщений от пользователей"""
     try:
         # Получаем данные пользователя
-        user_id = message.from_user.id
-        user_name = message.from_user.full_name or "Не указано"
-        username = message.from_user.username
+        user = message.from_user
+        user_id = user.id
         
-        # Формируем ссылку на профиль
-        if username:
-            profile_link = f"https://t.me/{username}"
-        else:
-            profile_link = f"tg://user?id={user_id}"
+        # Читаем поля сообщения один раз
+        photo = message.photo
+        video = message.video
+        document = message.document
         
         # Копируем сообщение пользователя в админский чат
         user_message_text = message.text or message.caption or "[Медиа-файл]"
         
         # Отправляем сообщение админу
-        admin_message = (
-            f"<b>Сообщение от пользователя:</b>\n\n"
-            f"{user_message_text}\n\n"
-            f"<b>Данные пользователя:</b>\n"
-            f"ID: {user_id}\n"
-            f"Имя: {user_name}\n"
-            f"Профиль: <a href=\"{profile_link}\">t.me/{username if username else f'user?id={user_id}'}</a>"
+        fields = _profile_fields(user)
+        fields["body"] = user_message_text
+        admin_message = ADMIN_MSG_TMPL.format_map(fields)
+        
+        # Определяем тип вложения один раз
+        kind = (
+            "photo" if photo else
+            "video" if video else
+            "document" if document else
+            None
         )
         
-        # Если это медиа-файл, отправляем его с подписью
-        if message.photo:
-            sent_message = await bot.send_photo(
-                chat_id=ADMIN_CHAT_ID_INT,
-                photo=message.photo[-1].file_id,
-                caption=admin_message,
-                parse_mode=ParseMode.HTML,
-                reply_markup=create_reply_button(user_id)
-            )
-            user_message_map[sent_message.message_id] = user_id
-        elif message.video:
-            sent_message = await bot.send_video(
-                chat_id=ADMIN_CHAT_ID_INT,
-                video=message.video.file_id,
-                caption=admin_message,
-                parse_mode=ParseMode.HTML,
-                reply_markup=create_reply_button(user_id)
-            )
-            user_message_map[sent_message.message_id] = user_id
-        elif message.document:
-            sent_message = await bot.send_document(
-                chat_id=ADMIN_CHAT_ID_INT,
-                document=message.document.file_id,
-                caption=admin_message,
-                parse_mode=ParseMode.HTML,
-                reply_markup=create_reply_button(user_id)
-            )
-            user_message_map[sent_message.message_id] = user_id
+        # Пересылаем админу через общую очередь (сохраняет порядок сообщений),
+        # чтобы сразу подтвердить пользователю; соответствие сохранит обработчик очереди
+        if kind:
+            # Если это медиа-файл, отправляем его с подписью
+            file_id = photo[-1].file_id if photo else (video or document).file_id
+            _enqueue_admin(_MEDIA_SEND[kind], user_id, **{kind: file_id}, caption=admin_message)
         else:
-            # Отправляем текстовое сообщение админу
-            sent_message = await bot.send_message(
-                chat_id=ADMIN_CHAT_ID_INT,
-                text=admin_message,
-                parse_mode=ParseMode.HTML,
-                reply_markup=create_reply_button(user_id)
-            )
-            # Сохраняем соответствие между сообщением админу и ID пользователя
-            user_message_map[sent_message.message_id] = user_id
+            _enqueue_admin(bot.send_message, user_id, text=admin_message)
         
         # Подтверждаем пользователю, что сообщение получено
         await message.answer("Ваше сообщение отправлено, мы вскоре вам ответим ☺️")
         
     except Exception as e:
-        logger.error(f"Ошибка при обработке сообщения: {e}", exc_info=True)
+        logger.error("Ошибка при обработке сообщения: %s", e, exc_info=True)
         await message.answer("Произошла ошибка при отправке сообщения. Попробуйте позже.")
 
 
-async def send_daily_motivation():
-    """Отправляет случайную мотивирующую фразу в админский чат"""
+def send_daily_motivation():
+    """Ставит в очередь случайную мотивирующую фразу для админского чата"""
     try:
-        phrase = random.choice(MOTIVATIONAL_PHRASES)
+        phrase = _choice(MOTIVATIONAL_PHRASES)
         message_text = f"<b>Мотивация на день:</b>\n\n{phrase}"
-        await bot.send_message(
-            chat_id=ADMIN_CHAT_ID_INT,
-            text=message_text,
-            parse_mode=ParseMode.HTML
-        )
-        logger.info("Мотивирующая фраза отправлена в админский чат")
+        _enqueue_admin(bot.send_message, text=message_text)
+        logger.info("Мотивирующая фраза поставлена в очередь для админского чата")
     except Exception as e:
-        logger.error(f"Ошибка при отправке мотивирующей фразы: {e}", exc_info=True)
+        logger.error("Ошибка при отправке мотивирующей фразы: %s", e, exc_info=True)
+
+
+async def daily_motivation_loop():
+    """Раз в день отправляет мотивацию в админский чат (в 8:40 МСК)"""
+    moscow_tz = ZoneInfo("Europe/Moscow")
+    now = datetime.now(moscow_tz)
+    target = now.replace(hour=8, minute=40, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    while True:
+        # sleep может проснуться чуть раньше срока, поэтому досыпаем до target
+        while (delay := (target - datetime.now(moscow_tz)).total_seconds()) > 0:
+            await asyncio.sleep(delay)
+        send_daily_motivation()
+        
+        # Каждый слот срабатывает ровно один раз; пропущенные дни не догоняем
+        now = datetime.now(moscow_tz)
+        while target <= now:
+            target += timedelta(days=1)
+
+
+async def admin_outbox_worker():
+    """Отправляет сообщения из очереди в админский чат по одному, в порядке поступления"""
+    while True:
+        send, kwargs, user_id = await _admin_outbox.get()
+        try:
+            sent_message = await send(
+                chat_id=ADMIN_CHAT_ID_INT,
+                parse_mode=ParseMode.HTML,
+                reply_markup=create_reply_button(user_id) if user_id is not None else None,
+                **kwargs
+            )
+            if user_id is not None:
+                # Сохраняем соответствие между сообщением админу и ID пользователя
+                _put(user_message_map, sent_message.message_id, user_id)
+            logger.info("Сообщение отправлено в админский чат (message_id=%s)", sent_message.message_id)
+        except Exception as e:
+            logger.error("Ошибка при отправке сообщения в админский чат: %s", e, exc_info=True)
+        finally:
+            _admin_outbox.task_done()
+
+
+async def drain_pending_sends():
+    """Дожидается отправки очереди админского чата перед закрытием сессии"""
+    try:
+        await asyncio.wait_for(_admin_outbox.join(), ADMIN_OUTBOX_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Не все сообщения отправлены до остановки: в очереди %s", _admin_outbox.qsize())
+
+
+async def run_webhook():
+    """Запускает aiohttp-сервер и регистрирует webhook в Telegram"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=urlsplit(WEBHOOK_URL).path or "/")
+    # Вызывает startup/shutdown-обработчики диспетчера вместе с сервером
+    setup_application(app, dp, bot=bot)
+    
+    # Останавливаемся по SIGTERM/SIGINT (docker stop, Ctrl+C)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+    
+    await bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info("Webhook установлен: %s, сервер слушает %s:%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT)
+    
+    try:
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки, завершаем работу webhook-сервера")
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        # Перестаем принимать обновления и досылаем начатое до того,
+        # как SimpleRequestHandler закроет сессию бота в on_shutdown
+        await site.stop()
+        await drain_pending_sends()
+        await runner.cleanup()
 
 
 async def main():
     """Главная функция запуска бота"""
     logger.info("Запуск бота...")
     
-    # Настройка планировщика для ежедневной отправки мотивации в 9:00 МСК
-    moscow_tz = ZoneInfo("Europe/Moscow")
-    scheduler = AsyncIOScheduler(timezone=moscow_tz)
-    scheduler.add_job(
-        send_daily_motivation,
-        trigger=CronTrigger(hour=8, minute=40, timezone=moscow_tz),  # Каждый день в 9:00 МСК
-        id='daily_motivation',
-        name='Ежедневная мотивация',
-        replace_existing=True
-    )
-    scheduler.start()
-    logger.info("Планировщик запущен. Мотивация будет отправляться каждый день в 9:00 МСК")
+    # Обработчик очереди сообщений для админского чата
+    outbox_task = asyncio.create_task(admin_outbox_worker())
+    
+    # Фоновая задача для ежедневной отправки мотивации
+    motivation_task = asyncio.create_task(daily_motivation_loop())
+    logger.info("Фоновая задача запущена. Мотивация будет отправляться каждый день в 08:40 МСК")
     
     try:
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            # Сессию закрываем сами после досылки сообщений
+            await dp.start_polling(bot, close_bot_session=False)
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}", exc_info=True)
+        logger.error("Ошибка при запуске бота: %s", e, exc_info=True)
     finally:
-        scheduler.shutdown()
+        motivation_task.cancel()
+        
+        # Досылаем накопленные сообщения перед остановкой
+        await drain_pending_sends()
+        outbox_task.cancel()
         await bot.session.close()
 
 
 if __name__ == '__main__':
-    import asyncio
-    asyncio.run(main())
+    # uvloop вместо стандартного event loop asyncio
+    uvloop.run(main())
@@ -7,39 +7,20 @@
 import os
 import time
 from pathlib import Path
+from dotenv import dotenv_values
 from pytapo import Tapo
 
 
 def load_env_file(env_path=".env"):
     """Загрузить переменные из .env файла."""
-    env_vars = {}
-    env_file = Path(env_path)
-    
-    if not env_file.exists():
-        return env_vars
+    if not Path(env_path).exists():
+        return {}
     
     try:
-        with open(env_file, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                # Пропускаем пустые строки и комментарии
-                if not line or line.startswith("#"):
-                    continue
-                # Разбираем KEY=VALUE
-                if "=" in line:
-                    key, value = line.split("=", 1)
-                    key = key.strip()
-                    value = value.strip()
-                    # Убираем кавычки если есть
-                    if value.startswith('"') and value.endswith('"'):
-                        value = value[1:-1]
-                    elif value.startswith("'") and value.endswith("'"):
-                        value = value[1:-1]
-                    env_vars[key] = value
+        return dotenv_values(env_path)
     except Exception as e:
         print(f"⚠ Предупреждение: не удалось прочитать .env файл: {e}")
-    
-    return env_vars
+        return {}
 
 
 class TapoExplorer: